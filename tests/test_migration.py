@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import date, timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "weatherbot"))
+
+import bot  # noqa: E402
+
+
+class LegacyMigrationTest(unittest.TestCase):
+    """Databases created by the original bot: subscriptions(chat_id, location, date, forecast)."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.tomorrow = date.today() + timedelta(days=1)
+        conn = sqlite3.connect(self.path)
+        with conn:
+            conn.execute(
+                "CREATE TABLE subscriptions("
+                "chat_id INTEGER, location TEXT, date TEXT, forecast TEXT, PRIMARY KEY(chat_id, location, date)"
+                ")"
+            )
+            conn.executemany(
+                "INSERT INTO subscriptions VALUES (?, ?, ?, ?)",
+                [
+                    (1, "Москва", f"{self.tomorrow.year}-{self.tomorrow.month}-{self.tomorrow.day}", "ясно"),
+                    (2, " москва ", "2099-01-01", "ясно"),
+                    (3, "Казань", self.tomorrow.isoformat(), "дождь"),
+                ],
+            )
+        conn.close()
+
+    def _open(self) -> bot.SubscriptionDB:
+        db = bot.SubscriptionDB(self.path)
+        self.addCleanup(db.close)
+        return db
+
+    def test_migrates_rows_onto_locations(self):
+        db = self._open()
+        rows = sorted(db.get_subscriptions())
+        self.assertEqual(len(rows), 3)
+        (_, moscow, tomorrow, snapshot), (_, moscow_far, far, far_snapshot), (_, kazan, _, _) = rows
+        self.assertEqual(moscow, moscow_far)
+        self.assertNotEqual(moscow, kazan)
+        self.assertEqual(tomorrow, self.tomorrow.isoformat())
+        # Inside the horizon: stored silently by the first cycle; beyond it: announced later
+        self.assertEqual(snapshot, b"")
+        self.assertEqual((far, far_snapshot), ("2099-01-01", None))
+
+    def test_interrupted_migration_keeps_subscriptions(self):
+        calls = []
+
+        def fail_on_second_row(location):
+            calls.append(location)
+            if len(calls) == 2:
+                raise RuntimeError("interrupted")
+            return " ".join(location.split()).casefold()
+
+        with mock.patch.object(bot, "normalize_location", fail_on_second_row):
+            with self.assertRaises(RuntimeError):
+                bot.SubscriptionDB(self.path)
+
+        db = self._open()
+        self.assertEqual(len(list(db.get_subscriptions())), 3)
+        tables = {row[0] for row in db._conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        self.assertNotIn("subscriptions_legacy", tables)
+
+    def test_resumes_from_legacy_table(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("ALTER TABLE subscriptions RENAME TO subscriptions_legacy")
+        conn.close()
+        db = self._open()
+        self.assertEqual(len(list(db.get_subscriptions())), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,26 +1,49 @@
 from __future__ import annotations
 
+import argparse
 import asyncio
+import heapq
 import logging
 import os
 import sqlite3
-from datetime import datetime
-from typing import Dict, Tuple
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (Application, CallbackContext, CallbackQueryHandler,
                           CommandHandler, ConversationHandler, MessageHandler,
                           filters)
 
-from weather import WeatherService
+from delivery import Delivery
+from gazetteer import Gazetteer, Place
+from weather import (FORECAST_HORIZON_DAYS, DayForecast, PersistentForecastCache,
+                     SignificancePolicy, WeatherService, daily_index, normalize_location,
+                     snapshot_digest)
 
 
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
 
 DB_PATH = os.getenv("WEATHER_BOT_DB", "weather.db")
+FETCH_CONCURRENCY = int(os.getenv("WEATHER_FETCH_CONCURRENCY", "10"))
+DB_BATCH_SIZE = int(os.getenv("WEATHER_DB_BATCH_SIZE", "500"))
+DB_FETCH_SIZE = int(os.getenv("WEATHER_DB_FETCH_SIZE", "1000"))
+UPDATE_INTERVAL_MINUTES = float(os.getenv("WEATHER_UPDATE_INTERVAL_MINUTES", "60"))
+# Optional crontab expression, e.g. "0 */3 * * *"; takes precedence over the interval
+UPDATE_CRON = os.getenv("WEATHER_UPDATE_CRON")
+UPDATE_JITTER = int(os.getenv("WEATHER_UPDATE_JITTER", "120"))
+# Locations are split into this many shards refreshed at evenly spaced offsets within the interval
+UPDATE_SHARDS = int(os.getenv("WEATHER_UPDATE_SHARDS", "1"))
+# Locations whose nearest subscription is further ahead are refreshed up to this many times less often
+MAX_REFRESH_FACTOR = int(os.getenv("WEATHER_MAX_REFRESH_FACTOR", "8"))
+# Upper bound on locations fetched per cycle (0 = no limit); the most overdue go first
+MAX_FETCHES_PER_CYCLE = int(os.getenv("WEATHER_MAX_FETCHES_PER_CYCLE", "0"))
 
 SELECTING_LOCATION, SELECTING_DATE = range(2)
 
@@ -30,49 +53,358 @@ class SubscriptionDB:
 
     def __init__(self, path: str = DB_PATH):
         self.path = path
+        # One long-lived connection; all access happens on the event loop thread
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._configure()
         self._ensure_table()
 
+    def _configure(self) -> None:
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA cache_size=-16000")
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+
     def _ensure_table(self) -> None:
-        with sqlite3.connect(self.path) as conn:
-            conn.execute(
-                "CREATE TABLE IF NOT EXISTS subscriptions("
-                "chat_id INTEGER, location TEXT, date TEXT, forecast TEXT, PRIMARY KEY(chat_id, location, date)"
+        with self._conn:
+            # sqlite3 runs DDL outside a transaction unless one is opened explicitly, which
+            # would let an interrupted migration commit the renamed table without its rows
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS locations("
+                "id INTEGER PRIMARY KEY, name TEXT NOT NULL, city_id INTEGER UNIQUE, lat REAL, lon REAL, "
+                "refreshed_at REAL"
+                ")"
+            )
+            tables = {row[0] for row in self._conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(subscriptions)")}
+            if "location" in columns:
+                self._conn.execute("ALTER TABLE subscriptions RENAME TO subscriptions_legacy")
+                tables.add("subscriptions_legacy")
+            self._create_subscriptions()
+            if "subscriptions_legacy" in tables:
+                # Also resumes a migration left half-done by an earlier version
+                self._migrate_location_text()
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_subscriptions_location_date ON subscriptions(location_id, date)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_date ON subscriptions(date)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox("
+                "id INTEGER PRIMARY KEY, chat_id INTEGER, text TEXT, created_at REAL, sent_at REAL, "
+                "failed_at REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT"
                 ")"
             )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_outbox_unsent ON outbox(id) WHERE sent_at IS NULL AND failed_at IS NULL"
+            )
+
+    def _create_subscriptions(self) -> None:
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions("
+            "chat_id INTEGER, location_id INTEGER REFERENCES locations(id), date TEXT, snapshot BLOB, "
+            "digest BLOB, PRIMARY KEY(chat_id, location_id, date)"
+            ")"
+        )
+
+    @staticmethod
+    def _normalize_date(value: str) -> str:
+        """Zero-pad legacy dates such as ``2026-11-5`` so string range filters work."""
+        try:
+            return datetime.strptime(value.strip(), "%Y-%m-%d").date().isoformat()
+        except ValueError:
+            return value
+
+    def _migrate_location_text(self) -> None:
+        """Move subscriptions keyed by raw location text onto the locations table.
+
+        Rows within the forecast horizon get an empty snapshot, so the first update cycle
+        stores their forecast without notifying; further dates keep NULL and are announced
+        once the forecast reaches them.
+        """
+        horizon = (datetime.now().date() + timedelta(days=FORECAST_HORIZON_DAYS)).isoformat()
+        ids: Dict[str, int] = {}
+        rows = self._conn.execute("SELECT chat_id, location, date FROM subscriptions_legacy")
+        for chat_id, location, date in rows.fetchall():
+            date = self._normalize_date(date)
+            key = normalize_location(location)
+            if key not in ids:
+                ids[key] = self._conn.execute(
+                    "INSERT INTO locations(name) VALUES (?)", (" ".join(location.split()),)
+                ).lastrowid
+            self._conn.execute(
+                "INSERT OR REPLACE INTO subscriptions(chat_id, location_id, date, snapshot) VALUES (?, ?, ?, ?)",
+                (chat_id, ids[key], date, b"" if date <= horizon else None),
+            )
+        self._conn.execute("DROP TABLE subscriptions_legacy")
+        LOGGER.info("Migrated %d legacy location names to the locations table", len(ids))
+
+    def get_or_create_location(self, name: str, city_id: Optional[int], lat: float, lon: float) -> int:
+        """Return the id of the location for provider ``city_id``, creating it if needed.
+
+        Gazetteer entries without a provider id are matched on their coordinates instead.
+        """
+        with self._conn:
+            if city_id is None:
+                row = self._conn.execute(
+                    "SELECT id FROM locations WHERE city_id IS NULL AND lat=? AND lon=?", (lat, lon)
+                ).fetchone()
+                if row is not None:
+                    return row[0]
+                return self._conn.execute(
+                    "INSERT INTO locations(name, lat, lon) VALUES (?, ?, ?)", (name, lat, lon)
+                ).lastrowid
+            self._conn.execute(
+                "INSERT INTO locations(name, city_id, lat, lon) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(city_id) DO UPDATE SET name=excluded.name, lat=excluded.lat, lon=excluded.lon",
+                (name, city_id, lat, lon),
+            )
+            row = self._conn.execute("SELECT id FROM locations WHERE city_id=?", (city_id,)).fetchone()
+        return row[0]
+
+    def resolve_location(self, location_id: int, city_id: int, lat: float, lon: float) -> int:
+        """Attach a provider city to a location known only by name; return the surviving id.
+
+        When another location already has ``city_id``, the subscriptions are moved onto it
+        (keeping its rows where both exist) and this location is removed.
+        """
+        with self._conn:
+            row = self._conn.execute("SELECT id FROM locations WHERE city_id=?", (city_id,)).fetchone()
+            if row is None:
+                self._conn.execute(
+                    "UPDATE locations SET city_id=?, lat=?, lon=? WHERE id=?", (city_id, lat, lon, location_id)
+                )
+                return location_id
+            self._conn.execute(
+                "INSERT OR IGNORE INTO subscriptions(chat_id, location_id, date, snapshot, digest) "
+                "SELECT chat_id, ?, date, snapshot, digest FROM subscriptions WHERE location_id=?",
+                (row[0], location_id),
+            )
+            self._conn.execute("DELETE FROM subscriptions WHERE location_id=?", (location_id,))
+            self._conn.execute("DELETE FROM locations WHERE id=?", (location_id,))
+        return row[0]
+
+    def add_subscription(self, chat_id: int, location_id: int, date: str, snapshot: Optional[bytes] = None) -> None:
+        digest = snapshot_digest(snapshot) if snapshot is not None else None
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO subscriptions(chat_id, location_id, date, snapshot, digest) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (chat_id, location_id, date, snapshot, digest),
+            )
 
-    def add_subscription(self, chat_id: int, location: str, date: str, forecast: str) -> None:
-        with sqlite3.connect(self.path) as conn:
-            conn.execute(
-                "INSERT OR REPLACE INTO subscriptions(chat_id, location, date, forecast) VALUES (?, ?, ?, ?)",
-                (chat_id, location, date, forecast),
+    @staticmethod
+    def _date_filter(min_date: Optional[str], max_date: Optional[str]) -> Tuple[list[str], list]:
+        clauses: list[str] = []
+        params: list = []
+        if min_date is not None:
+            clauses.append("date >= ?")
+            params.append(min_date)
+        if max_date is not None:
+            clauses.append("date <= ?")
+            params.append(max_date)
+        return clauses, params
+
+    def get_locations(
+        self,
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        shard: int = 0,
+        shards: int = 1,
+    ) -> Iterator[Tuple[int, str, Optional[float], Optional[float], str, Optional[float]]]:
+        """Yield locations in ``shard`` with a subscription in the date window.
+
+        Rows are (id, name, lat, lon, nearest subscribed date, refreshed_at).
+        """
+        clauses, params = self._date_filter(min_date, max_date)
+        if shards > 1:
+            clauses.append("l.id % ? = ?")
+            params.extend((shards, shard))
+        query = (
+            "SELECT l.id, l.name, l.lat, l.lon, MIN(s.date), l.refreshed_at "
+            "FROM locations l JOIN subscriptions s ON s.location_id = l.id"
+        )
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " GROUP BY l.id"
+        yield from self._conn.execute(query, params)
+
+    def mark_refreshed(self, location_ids: Iterable[int], refreshed_at: float) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE locations SET refreshed_at=? WHERE id=?",
+                ((refreshed_at, location_id) for location_id in location_ids),
             )
 
-    def get_subscriptions(self) -> list[Tuple[int, str, str, str]]:
-        with sqlite3.connect(self.path) as conn:
-            cur = conn.execute("SELECT chat_id, location, date, forecast FROM subscriptions")
-            return cur.fetchall()
+    def get_subscriptions(
+        self,
+        location_id: Optional[int] = None,
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        chunk_size: int = DB_FETCH_SIZE,
+    ) -> Iterator[Tuple[int, int, str, Optional[bytes]]]:
+        """Stream subscriptions, optionally filtered by location and a date window."""
+        clauses, params = self._date_filter(min_date, max_date)
+        if location_id is not None:
+            clauses.append("location_id = ?")
+            params.append(location_id)
+        query = "SELECT chat_id, location_id, date, snapshot FROM subscriptions"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        yield from self._stream(query, params, chunk_size)
+
+    def get_changed_subscriptions(
+        self, location_id: int, digests: Dict[str, bytes], chunk_size: int = DB_FETCH_SIZE
+    ) -> Iterator[Tuple[int, str, Optional[bytes]]]:
+        """Stream (chat_id, date, snapshot) rows that have not seen the forecast in ``digests[date]``.
+
+        The digest of the last forecast a row was checked against is kept apart from the
+        snapshot it was last notified about, so the comparison runs inside sqlite and rows
+        already checked against this forecast never reach Python.
+        """
+        if not digests:
+            return
+        fresh = ", ".join("(?, ?)" for _ in digests)
+        query = (
+            f"WITH fresh(date, digest) AS (VALUES {fresh}) "
+            "SELECT s.chat_id, s.date, s.snapshot FROM subscriptions s "
+            "JOIN fresh f ON s.date = f.date "
+            "WHERE s.location_id = ? AND s.digest IS NOT f.digest"
+        )
+        params: list = [value for item in digests.items() for value in item]
+        params.append(location_id)
+        yield from self._stream(query, params, chunk_size)
 
-    def update_forecast(self, chat_id: int, location: str, date: str, forecast: str) -> None:
-        with sqlite3.connect(self.path) as conn:
-            conn.execute(
-                "UPDATE subscriptions SET forecast=? WHERE chat_id=? AND location=? AND date=?",
-                (forecast, chat_id, location, date),
+    def _stream(self, query: str, params: Iterable, chunk_size: int) -> Iterator[tuple]:
+        cur = self._conn.execute(query, tuple(params))
+        try:
+            while True:
+                chunk = cur.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                yield from chunk
+        finally:
+            cur.close()
+
+    def purge_expired(self, today: str) -> int:
+        """Delete subscriptions whose date is before ``today``; return the number removed.
+
+        Delivered or rejected outbox rows older than a day are dropped as well.
+        """
+        cutoff = time.time() - 24 * 3600
+        with self._conn:
+            cur = self._conn.execute("DELETE FROM subscriptions WHERE date < ?", (today,))
+            self._conn.execute("DELETE FROM outbox WHERE sent_at < ? OR failed_at < ?", (cutoff, cutoff))
+        return cur.rowcount
+
+    def update_forecast(self, chat_id: int, location_id: int, date: str, snapshot: bytes) -> None:
+        self.update_forecasts_many([(chat_id, location_id, date, snapshot)])
+
+    def update_forecasts_many(
+        self,
+        rows: Iterable[Tuple[int, int, str, bytes]],
+        notifications: Iterable[Tuple[int, str]] = (),
+        seen: Iterable[Tuple[int, str, bytes]] = (),
+    ) -> None:
+        """Update (chat_id, location_id, date, snapshot) rows in a single transaction.
+
+        (chat_id, text) ``notifications`` are written to the outbox and the (location_id,
+        date, digest) forecasts in ``seen`` recorded in the same transaction, so a stored
+        snapshot is never newer than the message announcing it and a crash never marks a
+        forecast as checked before its notifications exist.
+        """
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE subscriptions SET snapshot=? WHERE chat_id=? AND location_id=? AND date=?",
+                ((snapshot, chat_id, location_id, date) for chat_id, location_id, date, snapshot in rows),
+            )
+            self._conn.executemany(
+                "UPDATE subscriptions SET digest=? WHERE location_id=? AND date=? AND digest IS NOT ?",
+                ((digest, location_id, date, digest) for location_id, date, digest in seen),
+            )
+            now = time.time()
+            self._conn.executemany(
+                "INSERT INTO outbox(chat_id, text, created_at) VALUES (?, ?, ?)",
+                ((chat_id, text, now) for chat_id, text in notifications),
             )
 
+    def get_pending_notifications(self, after_id: int, limit: int) -> list[Tuple[int, int, str, int]]:
+        """Return up to ``limit`` undelivered (id, chat_id, text, attempts) outbox rows with id > ``after_id``."""
+        cur = self._conn.execute(
+            "SELECT id, chat_id, text, attempts FROM outbox "
+            "WHERE sent_at IS NULL AND failed_at IS NULL AND id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        )
+        return cur.fetchall()
+
+    def mark_sent(self, outbox_id: int) -> None:
+        with self._conn:
+            self._conn.execute("UPDATE outbox SET sent_at=? WHERE id=?", (time.time(), outbox_id))
+
+    def mark_failed(self, outbox_id: int, error: str) -> None:
+        """Record that Telegram permanently rejected an outbox row."""
+        with self._conn:
+            self._conn.execute("UPDATE outbox SET failed_at=?, error=? WHERE id=?", (time.time(), error, outbox_id))
+
+    def mark_deferred(self, outbox_id: int, error: str) -> None:
+        """Count a delivery attempt that left an outbox row pending."""
+        with self._conn:
+            self._conn.execute("UPDATE outbox SET attempts=attempts + 1, error=? WHERE id=?", (error, outbox_id))
+
+    def migrate_chat(self, old_chat_id: int, new_chat_id: int) -> None:
+        """Move subscriptions and pending notifications of a group that became a supergroup."""
+        with self._conn:
+            self._conn.execute(
+                "UPDATE OR REPLACE subscriptions SET chat_id=? WHERE chat_id=?", (new_chat_id, old_chat_id)
+            )
+            self._conn.execute(
+                "UPDATE outbox SET chat_id=? WHERE chat_id=? AND sent_at IS NULL AND failed_at IS NULL",
+                (new_chat_id, old_chat_id),
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
 
 class WeatherBot:
-    def __init__(self, token: str, weather_service: WeatherService, db: SubscriptionDB):
+    def __init__(
+        self,
+        token: str,
+        weather_service: WeatherService,
+        db: SubscriptionDB,
+        fetch_concurrency: int = FETCH_CONCURRENCY,
+        db_batch_size: int = DB_BATCH_SIZE,
+        policy: Optional[SignificancePolicy] = None,
+        gazetteer: Optional[Gazetteer] = None,
+    ):
         self.weather_service = weather_service
         self.db = db
-        self.app = Application.builder().token(token).build()
+        self.fetch_concurrency = fetch_concurrency
+        self.db_batch_size = db_batch_size
+        self.policy = policy or SignificancePolicy()
+        self.gazetteer = gazetteer
+        self.app = (
+            Application.builder()
+            .token(token)
+            .post_init(self._on_startup)
+            .post_shutdown(self._on_shutdown)
+            .build()
+        )
+        self.delivery = Delivery(self.app.bot, self.db)
         self.scheduler = AsyncIOScheduler()
+        self._cycles: set[asyncio.Task] = set()
+        # Seconds between two update cycles of a shard; measured from the trigger for cron schedules
+        self.cycle_seconds = UPDATE_INTERVAL_MINUTES * 60
         self._setup_handlers()
 
     def _setup_handlers(self) -> None:
         conv_handler = ConversationHandler(
             entry_points=[CommandHandler("start", self.start)],
             states={
-                SELECTING_LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.location_selected)],
+                SELECTING_LOCATION: [
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.location_selected),
+                    CallbackQueryHandler(self.city_chosen, pattern=r"^city:"),
+                ],
                 SELECTING_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.date_selected)],
             },
             fallbacks=[CommandHandler("cancel", self.cancel)],
@@ -95,31 +427,104 @@ class WeatherBot:
         return ConversationHandler.END
 
     async def location_selected(self, update: Update, context: CallbackContext) -> int:
-        context.user_data["location"] = update.message.text
+        if self.gazetteer is not None:
+            known = self.gazetteer.lookup(update.message.text)
+            if known is not None:
+                return await self._remember_place(update, context, known)
+            suggestions = self.gazetteer.suggest(update.message.text)
+            if suggestions:
+                names = Counter(place.name for place in suggestions)
+                keyboard = [
+                    [InlineKeyboardButton(self._place_label(place, names), callback_data=f"city:{place.index}")]
+                    for place in suggestions
+                ]
+                await update.message.reply_text(
+                    "Уточните город:", reply_markup=InlineKeyboardMarkup(keyboard)
+                )
+                return SELECTING_LOCATION
+
+        # Not in the offline index: fall back to the provider's geocoding
+        try:
+            place = await self.weather_service.aresolve(update.message.text)
+            if place is not None:
+                data = await self.weather_service.aget_forecast_at(place["lat"], place["lon"])
+                city_id = data["city"]["id"]
+        except Exception as exc:  # noqa: BLE001
+            LOGGER.error("Error resolving location %r: %s", update.message.text, exc)
+            await update.message.reply_text("Сервис погоды сейчас недоступен. Попробуйте позже.")
+            return SELECTING_LOCATION
+        if place is None:
+            await update.message.reply_text("Не удалось найти такой город. Попробуйте ещё раз.")
+            return SELECTING_LOCATION
+        context.user_data["location"] = place["name"]
+        context.user_data["coords"] = (place["lat"], place["lon"])
+        context.user_data["location_id"] = self.db.get_or_create_location(
+            place["name"], city_id, place["lat"], place["lon"]
+        )
         await update.message.reply_text("Введите дату в формате ГГГГ-ММ-ДД:")
         return SELECTING_DATE
 
+    @staticmethod
+    def _place_label(place: Place, names: Counter) -> str:
+        """Button text; cities sharing a name are told apart by their coordinates."""
+        if names[place.name] > 1:
+            return f"{place.name} ({place.lat:.2f}, {place.lon:.2f})"
+        return place.name
+
+    async def city_chosen(self, update: Update, context: CallbackContext) -> int:
+        query = update.callback_query
+        await query.answer()
+        place = self.gazetteer.record(int(query.data.split(":", 1)[1]))
+        return await self._remember_place(update, context, place)
+
+    async def _remember_place(self, update: Update, context: CallbackContext, place: Place) -> int:
+        context.user_data["location"] = place.name
+        context.user_data["coords"] = (place.lat, place.lon)
+        context.user_data["location_id"] = self.db.get_or_create_location(
+            place.name, place.city_id, place.lat, place.lon
+        )
+        await update.effective_message.reply_text(
+            f"Город: {place.name}. Введите дату в формате ГГГГ-ММ-ДД:"
+        )
+        return SELECTING_DATE
+
     async def date_selected(self, update: Update, context: CallbackContext) -> int:
         date_text = update.message.text
         location = context.user_data["location"]
+        location_id = context.user_data["location_id"]
+        lat, lon = context.user_data["coords"]
         try:
             date = datetime.strptime(date_text, "%Y-%m-%d").date()
         except ValueError:
             await update.message.reply_text("Неверный формат даты. Попробуйте ещё раз.")
             return SELECTING_DATE
+        if date < datetime.now().date():
+            await update.message.reply_text("Эта дата уже прошла. Введите другую дату.")
+            return SELECTING_DATE
+        # Store zero-padded ISO dates so range queries on the date column compare correctly
+        date_text = date.isoformat()
+
+        if date > datetime.now().date() + timedelta(days=FORECAST_HORIZON_DAYS):
+            # The provider has no forecast this far ahead; the first update cycle after
+            # the date enters the horizon will deliver it
+            self.db.add_subscription(update.effective_chat.id, location_id, date_text)
+            await update.message.reply_text(
+                f"Подписка добавлена. Прогноз в {location} на {date_text} пока недоступен, "
+                "пришлём его, как только он появится."
+            )
+            return ConversationHandler.END
 
-        forecast = self._get_weather_text(location)
-        self.db.add_subscription(update.effective_chat.id, location, date_text, forecast)
+        try:
+            day = (await self._get_daily_forecast(location, lat, lon)).get(date_text)
+        except Exception as exc:  # noqa: BLE001
+            LOGGER.error("Error getting weather: %s", exc)
+            day = None
+        # The snapshot is fresh, so no update cycle is triggered for the new row; one stored
+        # without a snapshot is filled in and notified by the next regular cycle
+        snapshot = day.snapshot() if day is not None else None
+        self.db.add_subscription(update.effective_chat.id, location_id, date_text, snapshot)
         await update.message.reply_text(
-            f"Подписка добавлена. Погода в {location} на {date_text}:\n{forecast}"
-        )
-
-        # Schedule first check a bit later
-        self.scheduler.add_job(
-            self.check_updates,
-            trigger=DateTrigger(run_date=datetime.utcnow()),
-            id="check_updates",
-            replace_existing=True,
+            f"Подписка добавлена. Погода в {location} на {date_text}:\n{self._format_day(day)}"
         )
         return ConversationHandler.END
 
@@ -127,43 +532,233 @@ class WeatherBot:
         query = update.callback_query
         await query.answer()
 
-    def _get_weather_text(self, location: str) -> str:
-        data = self.weather_service.get_forecast(location)
-        if "list" not in data:
+    async def _get_forecast(self, location: str, lat: Optional[float] = None, lon: Optional[float] = None) -> dict:
+        if lat is None or lon is None:
+            # Locations migrated from free-text subscriptions have no coordinates until the
+            # first update cycle resolves them from the response
+            return await self.weather_service.aget_forecast(location)
+        return await self.weather_service.aget_forecast_at(lat, lon)
+
+    async def _get_daily_forecast(
+        self, location: str, lat: Optional[float] = None, lon: Optional[float] = None
+    ) -> Dict[str, DayForecast]:
+        return daily_index(await self._get_forecast(location, lat, lon))
+
+    @staticmethod
+    def _format_day(day: Optional[DayForecast]) -> str:
+        if day is None:
             return "Не удалось получить прогноз."
-        item = data["list"][0]
-        description = item["weather"][0]["description"]
-        temp = item["main"]["temp"]
-        return f"{description}, {temp}°C"
-
-    async def check_updates(self) -> None:
-        LOGGER.info("Checking weather updates...")
-        for chat_id, location, date, old_forecast in self.db.get_subscriptions():
+        return f"{day.description}, {day.temp_min:.0f}…{day.temp_max:.0f}°C"
+
+    def _update_trigger(self, start_date: datetime) -> BaseTrigger:
+        if UPDATE_CRON:
+            trigger = CronTrigger.from_crontab(UPDATE_CRON)
+            # from_crontab() has no jitter argument
+            trigger.jitter = UPDATE_JITTER
+            return trigger
+        return IntervalTrigger(minutes=UPDATE_INTERVAL_MINUTES, start_date=start_date, jitter=UPDATE_JITTER)
+
+    def _refresh_period(self, days_ahead: int, learned_interval: float) -> float:
+        """Seconds between refreshes of a location whose nearest subscription is ``days_ahead`` away.
+
+        The provider-learned interval is used for today and tomorrow and doubles with each
+        further day. Half a cycle is subtracted so scheduler jitter does not push a due
+        location to the next cycle.
+        """
+        factor = min(2 ** max(days_ahead - 1, 0), MAX_REFRESH_FACTOR)
+        return factor * learned_interval - self.cycle_seconds / 2
+
+    async def check_updates(self, shard: int = 0, shards: int = 1) -> None:
+        LOGGER.info("Checking weather updates (shard %d/%d)...", shard + 1, shards)
+        started = time.monotonic()
+        today = datetime.now().date()
+        min_date = today.isoformat()
+        max_date = (today + timedelta(days=FORECAST_HORIZON_DAYS)).isoformat()
+        purged = self.db.purge_expired(min_date)
+        if purged:
+            LOGGER.info("Purged %d expired subscriptions", purged)
+
+        # Locations that are due are fetched once each, most overdue first; their
+        # subscription rows are streamed once the forecast arrives
+        now = time.time()
+        due: list = []
+        skipped = 0
+        for location_id, location, lat, lon, nearest, refreshed_at in self.db.get_locations(
+            min_date, max_date, shard, shards
+        ):
+            days_ahead = (datetime.strptime(nearest, "%Y-%m-%d").date() - today).days
+            learned = self.weather_service.refresh_interval(location, lat, lon)
+            next_due = (refreshed_at or 0.0) + self._refresh_period(days_ahead, learned)
+            if next_due <= now:
+                heapq.heappush(due, (next_due, nearest, location_id, location, lat, lon))
+            else:
+                skipped += 1
+
+        semaphore = asyncio.Semaphore(self.fetch_concurrency)
+        in_flight = 0
+        peak = 0
+
+        async def fetch(location_id: int, location: str, lat: Optional[float], lon: Optional[float]):
+            nonlocal in_flight, peak
+            async with semaphore:
+                in_flight += 1
+                peak = max(peak, in_flight)
+                try:
+                    return location_id, location, lat, await self._get_forecast(location, lat, lon)
+                finally:
+                    in_flight -= 1
+
+        pending: list[Tuple[int, int, str, bytes]] = []
+        notifications: list[Tuple[int, str]] = []
+        seen: list[Tuple[int, str, bytes]] = []
+        refreshed: list[int] = []
+        unresolved: list[Tuple[int, dict]] = []
+        tasks = []
+        # Tasks queue on the semaphore in creation order, so heap order is fetch order
+        while due and (not MAX_FETCHES_PER_CYCLE or len(tasks) < MAX_FETCHES_PER_CYCLE):
+            _, _, *row = heapq.heappop(due)
+            tasks.append(asyncio.create_task(fetch(*row)))
+        for next_done in asyncio.as_completed(tasks):
             try:
-                new_forecast = self._get_weather_text(location)
+                location_id, location, lat, data = await next_done
+                days = daily_index(data)
             except Exception as exc:  # noqa: BLE001
                 LOGGER.error("Error getting weather: %s", exc)
                 continue
-            if new_forecast != old_forecast:
-                self.db.update_forecast(chat_id, location, date, new_forecast)
-                await self.app.bot.send_message(
-                    chat_id=chat_id,
-                    text=(
-                        f"Обновлённый прогноз погоды в {location} на {date}:\n{new_forecast}"
-                    ),
-                )
+            refreshed.append(location_id)
+            if lat is None and "id" in data.get("city", {}):
+                unresolved.append((location_id, data["city"]))
+            # One snapshot per fully covered date in the horizon; sqlite returns only rows
+            # not yet checked against it
+            snapshots = {
+                date: day.snapshot() for date, day in days.items() if min_date <= date <= max_date and day.complete
+            }
+            digests = {date: snapshot_digest(snapshot) for date, snapshot in snapshots.items()}
+            for chat_id, date, old_snapshot in self.db.get_changed_subscriptions(location_id, digests):
+                new_snapshot = snapshots[date]
+                if old_snapshot is not None and not self.policy.comparable(old_snapshot, new_snapshot):
+                    # Migrated rows (empty snapshot) and rows sharing no slot with the new
+                    # forecast have nothing to compare against, so store it silently
+                    pending.append((chat_id, location_id, date, new_snapshot))
+                elif self.policy.is_significant(old_snapshot, new_snapshot):
+                    day = days[date]
+                    pending.append((chat_id, location_id, date, new_snapshot))
+                    notifications.append(
+                        (chat_id, f"Обновлённый прогноз погоды в {location} на {date}:\n{self._format_day(day)}")
+                    )
+                if len(pending) >= self.db_batch_size:
+                    self.db.update_forecasts_many(pending, notifications, seen)
+                    self.delivery.wake()
+                    pending.clear()
+                    notifications.clear()
+                    seen.clear()
+            # Recorded once the location's rows are streamed, in the same batch as their updates
+            seen.extend((location_id, date, digest) for date, digest in digests.items())
+        if pending or seen:
+            self.db.update_forecasts_many(pending, notifications, seen)
+            self.delivery.wake()
+        self.db.mark_refreshed(refreshed, now)
+        # After the last batch, so no pending update still refers to a merged location
+        for location_id, city in unresolved:
+            merged_into = self.db.resolve_location(
+                location_id, city["id"], city["coord"]["lat"], city["coord"]["lon"]
+            )
+            if merged_into != location_id:
+                LOGGER.info("Merged location %d into %d (city %s)", location_id, merged_into, city["id"])
+
+        LOGGER.info(
+            "Update cycle for shard %d/%d finished in %.2fs: %d locations fetched, %d deferred, %d not due, "
+            "peak concurrency %d/%d",
+            shard + 1,
+            shards,
+            time.monotonic() - started,
+            len(tasks),
+            len(due),
+            skipped,
+            peak,
+            self.fetch_concurrency,
+        )
+        self.weather_service.cache.flush()
+        LOGGER.info("Forecast cache: %s", self.weather_service.cache.stats())
+        LOGGER.info("Adaptive refresh intervals: %s", self.weather_service.changes.stats())
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            for key, learned in self.weather_service.changes.intervals().items():
+                LOGGER.debug("Refresh interval for %s: %s", key, learned)
+        LOGGER.info("Delivery: %s", self.delivery.stats())
+
+    async def _run_cycle(self, shard: int, shards: int) -> None:
+        """Scheduler entry point; tracks the running cycle so shutdown can cancel it."""
+        task = asyncio.current_task()
+        self._cycles.add(task)
+        try:
+            await self.check_updates(shard, shards)
+        finally:
+            self._cycles.discard(task)
+
+    async def _on_startup(self, app: Application) -> None:
+        self.delivery.start()
+        # Started here so the scheduler shares the application's running event loop; jobs are
+        # added just before so the first shard runs right away
+        self._schedule_updates()
+        self.scheduler.start()
+
+    async def _on_shutdown(self, app: Application) -> None:
+        # Stop update cycles first so none touches the database while it is closed
+        if self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+        for task in self._cycles:
+            task.cancel()
+        await asyncio.gather(*self._cycles, return_exceptions=True)
+        await self.delivery.stop()
+        await self.weather_service.aclose()
+        self.db.close()
+
+    def _schedule_updates(self) -> None:
+        # Cron schedules have no fixed period to spread shards over, so they refresh everything at once
+        shards = 1 if UPDATE_CRON else max(UPDATE_SHARDS, 1)
+        offset = timedelta(minutes=UPDATE_INTERVAL_MINUTES) / shards
+        now = datetime.now()
+        if UPDATE_CRON:
+            # Cron fire times need not be evenly spaced; the gap after the next one is used
+            trigger = self._update_trigger(now)
+            first = trigger.get_next_fire_time(None, datetime.now(trigger.timezone))
+            second = first and trigger.get_next_fire_time(first, first + timedelta(seconds=1))
+            if second is not None:
+                self.cycle_seconds = (second - first).total_seconds()
+        for shard in range(shards):
+            # The first run of each shard is set explicitly: a trigger alone would wait a
+            # whole period once its start date has passed
+            self.scheduler.add_job(
+                self._run_cycle,
+                trigger=self._update_trigger(now + offset * shard),
+                args=(shard, shards),
+                id=f"check_updates_{shard}",
+                coalesce=True,
+                max_instances=1,
+                replace_existing=True,
+                next_run_time=now + offset * shard,
+            )
 
     def run(self) -> None:
-        self.scheduler.start()
         LOGGER.info("Bot started")
         self.app.run_polling()
 
 
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Weather subscription Telegram bot")
+    parser.add_argument(
+        "--cold-start",
+        action="store_true",
+        default=os.getenv("WEATHER_COLD_START") == "1",
+        help="discard the persisted forecast cache on startup",
+    )
+    args = parser.parse_args()
+
     token = os.getenv("TELEGRAM_TOKEN")
     if not token:
         raise RuntimeError("TELEGRAM_TOKEN environment variable is required")
-    bot = WeatherBot(token, WeatherService(), SubscriptionDB())
+    cache = PersistentForecastCache(DB_PATH, cold_start=args.cold_start)
+    bot = WeatherBot(token, WeatherService(cache=cache), SubscriptionDB(), gazetteer=Gazetteer())
     bot.run()
 
 
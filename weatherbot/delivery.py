@@ -0,0 +1,258 @@
+"""Paced delivery of outbound Telegram notifications from the durable outbox."""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional, Protocol, Set, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter, TelegramError
+
+LOGGER = logging.getLogger(__name__)
+
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "4"))
+DELIVERY_QUEUE_SIZE = int(os.getenv("DELIVERY_QUEUE_SIZE", "1000"))
+MAX_ATTEMPTS = 5
+# Upper bound in seconds on the backoff between attempts after a network error
+MAX_BACKOFF = 30.0
+# Fallback poll so rows written by a previous process are picked up without a wake-up
+OUTBOX_POLL_INTERVAL = 5.0
+# Rows left pending by a failed send are read again after this many seconds
+OUTBOX_RETRY_INTERVAL = float(os.getenv("OUTBOX_RETRY_INTERVAL", "60"))
+# Deliveries left pending this many times are marked failed instead of retried again
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "5"))
+
+
+class Outbox(Protocol):
+    def get_pending_notifications(self, after_id: int, limit: int) -> List[Tuple[int, int, str, int]]: ...
+
+    def mark_sent(self, outbox_id: int) -> None: ...
+
+    def mark_failed(self, outbox_id: int, error: str) -> None: ...
+
+    def mark_deferred(self, outbox_id: int, error: str) -> None: ...
+
+    def migrate_chat(self, old_chat_id: int, new_chat_id: int) -> None: ...
+
+
+class Notification(NamedTuple):
+    outbox_id: int
+    chat_id: int
+    text: str
+    enqueued_at: float
+    # Earlier deliveries of this row that were left pending
+    attempts: int = 0
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at ``rate`` tokens per second."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class DeliveryStats:
+    """Counters and latency totals for :class:`Delivery`."""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.max_depth = 0
+        self.send_seconds = 0.0
+        self.queued_seconds = 0.0
+
+    def as_dict(self, depth: int) -> dict:
+        delivered = max(self.sent, 1)
+        return {
+            "depth": depth,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "avg_send_ms": round(self.send_seconds / delivered * 1000, 1),
+            "avg_latency_ms": round(self.queued_seconds / delivered * 1000, 1),
+        }
+
+
+class Delivery:
+    """Drains the outbox through a bounded queue and worker tasks under global and per-chat rate limits.
+
+    A pump task reads undelivered outbox rows in id order and blocks while the queue is
+    full; rows are marked sent only after Telegram accepted them and failed only when it
+    rejected them permanently, so anything still pending after a crash is delivered on
+    the next start. Rows left pending by a failed send are picked up again by a periodic
+    rescan, up to ``OUTBOX_MAX_RETRIES`` times.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        outbox: Outbox,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        workers: int = DELIVERY_WORKERS,
+        queue_size: int = DELIVERY_QUEUE_SIZE,
+    ):
+        self.bot = bot
+        self.outbox = outbox
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self.queue: "asyncio.Queue[Notification]" = asyncio.Queue(maxsize=queue_size)
+        self.metrics = DeliveryStats()
+        self._global = TokenBucket(global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._resume_at = 0.0
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        # Outbox ids queued or being sent, so a rescan does not enqueue them twice
+        self._in_flight: Set[int] = set()
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._pump()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self) -> None:
+        """Signal that new rows were written to the outbox."""
+        self._wake.set()
+
+    async def _pump(self) -> None:
+        last_id = 0
+        rescanned = time.monotonic()
+        while True:
+            rows = self.outbox.get_pending_notifications(last_id, self.queue.maxsize or 100)
+            if not rows:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    if time.monotonic() - rescanned >= OUTBOX_RETRY_INTERVAL:
+                        # Start over from the oldest row to retry sends left pending
+                        last_id = 0
+                        rescanned = time.monotonic()
+                self._wake.clear()
+                continue
+            for outbox_id, chat_id, text, attempts in rows:
+                last_id = outbox_id
+                if outbox_id in self._in_flight:
+                    continue
+                self._in_flight.add(outbox_id)
+                await self.queue.put(Notification(outbox_id, chat_id, text, time.monotonic(), attempts))
+                self.metrics.max_depth = max(self.metrics.max_depth, self.queue.qsize())
+
+    def stats(self) -> dict:
+        return self.metrics.as_dict(self.queue.qsize())
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Idle chats have refilled completely and can be forgotten
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_full()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        return bucket
+
+    async def _run(self) -> None:
+        while True:
+            notification = await self.queue.get()
+            try:
+                await self._send(notification)
+            except Exception as exc:  # noqa: BLE001
+                LOGGER.exception("Error delivering notification %s", notification.outbox_id)
+                try:
+                    self._defer(notification, repr(exc))
+                except Exception:  # noqa: BLE001
+                    LOGGER.exception("Error recording delivery of notification %s", notification.outbox_id)
+            finally:
+                self._in_flight.discard(notification.outbox_id)
+                self.queue.task_done()
+
+    async def _send(self, notification: Notification) -> None:
+        # Retried in place: requeueing into a full queue could deadlock the workers
+        for attempt in range(MAX_ATTEMPTS):
+            delay = self._resume_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._chat_bucket(notification.chat_id).acquire()
+            await self._global.acquire()
+            started = time.monotonic()
+            try:
+                await self.bot.send_message(chat_id=notification.chat_id, text=notification.text)
+            except RetryAfter as exc:
+                LOGGER.warning("Telegram flood control, pausing sends for %ss", exc.retry_after)
+                self._resume_at = max(self._resume_at, time.monotonic() + float(exc.retry_after))
+                self.metrics.retried += 1
+                continue
+            except ChatMigrated as exc:
+                # The group became a supergroup; move its subscriptions and resend there
+                LOGGER.info("Chat %s migrated to %s", notification.chat_id, exc.new_chat_id)
+                self.outbox.migrate_chat(notification.chat_id, exc.new_chat_id)
+                notification = notification._replace(chat_id=exc.new_chat_id)
+                continue
+            except (Forbidden, BadRequest) as exc:
+                # Blocked bot, deleted chat or malformed message: retrying cannot help
+                LOGGER.error("Notification to %s rejected: %s", notification.chat_id, exc)
+                self.outbox.mark_failed(notification.outbox_id, str(exc))
+                self.metrics.failed += 1
+                return
+            except NetworkError as exc:
+                LOGGER.warning(
+                    "Error sending notification to %s (attempt %d/%d): %s",
+                    notification.chat_id,
+                    attempt + 1,
+                    MAX_ATTEMPTS,
+                    exc,
+                )
+                self.metrics.retried += 1
+                await asyncio.sleep(min(2 ** attempt, MAX_BACKOFF))
+                continue
+            except TelegramError as exc:
+                LOGGER.error("Error sending notification to %s: %s", notification.chat_id, exc)
+                self._defer(notification, str(exc))
+                return
+            finished = time.monotonic()
+            self.outbox.mark_sent(notification.outbox_id)
+            self.metrics.sent += 1
+            self.metrics.send_seconds += finished - started
+            self.metrics.queued_seconds += finished - notification.enqueued_at
+            return
+        LOGGER.warning("Giving up on notification %s for now", notification.outbox_id)
+        self._defer(notification, "retries exhausted")
+
+    def _defer(self, notification: Notification, error: str) -> None:
+        """Leave a row pending for the next rescan, or fail it once it ran out of retries."""
+        if notification.attempts + 1 >= OUTBOX_MAX_RETRIES:
+            self.outbox.mark_failed(notification.outbox_id, error)
+            self.metrics.failed += 1
+        else:
+            self.outbox.mark_deferred(notification.outbox_id, error)
@@ -0,0 +1,152 @@
+"""Offline city index used to validate and suggest locations without network calls."""
+
+import json
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from difflib import get_close_matches
+from typing import Dict, List, NamedTuple, Optional
+
+from weather import normalize_location
+
+GAZETTEER_PATH = os.getenv(
+    "WEATHER_GAZETTEER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cities.tsv")
+)
+SUGGESTION_LIMIT = 5
+# Keys on each side of the query's sort position considered for fuzzy suggestions
+FUZZY_WINDOW = int(os.getenv("WEATHER_FUZZY_WINDOW", "200"))
+
+
+class Place(NamedTuple):
+    index: int
+    name: str
+    lat: float
+    lon: float
+    city_id: Optional[int]
+
+
+class _Keys:
+    """Sequence view over the sorted keys so :func:`bisect_left` can search the mmap directly."""
+
+    def __init__(self, gazetteer: "Gazetteer"):
+        self._gazetteer = gazetteer
+
+    def __len__(self) -> int:
+        return len(self._gazetteer)
+
+    def __getitem__(self, index: int) -> bytes:
+        return self._gazetteer._key(index)
+
+
+class Gazetteer:
+    """Memory-mapped, sorted ``key<TAB>name<TAB>lat<TAB>lon<TAB>city_id`` file.
+
+    Keys are normalized names (several keys may point at the same city, e.g. an
+    English alias); only line offsets are kept in memory.
+    """
+
+    def __init__(self, path: str = GAZETTEER_PATH):
+        self.path = path
+        with open(path, "rb") as fh:
+            self._data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = array("Q")
+        pos = 0
+        while pos < len(self._data):
+            self._offsets.append(pos)
+            end = self._data.find(b"\n", pos)
+            pos = len(self._data) if end == -1 else end + 1
+        self._keys = _Keys(self)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def _key(self, index: int) -> bytes:
+        start = self._offsets[index]
+        return self._data[start:self._data.find(b"\t", start)]
+
+    def record(self, index: int) -> Place:
+        start = self._offsets[index]
+        end = self._data.find(b"\n", start)
+        line = self._data[start:] if end == -1 else self._data[start:end]
+        _, name, lat, lon, city_id = line.decode("utf-8").split("\t")
+        return Place(index, name, float(lat), float(lon), int(city_id) if city_id else None)
+
+    def _range(self, prefix: bytes, limit: Optional[int] = None) -> range:
+        """Indexes of keys starting with ``prefix``, at most ``limit`` of them."""
+        lo = bisect_left(self._keys, prefix)
+        end = len(self) if limit is None else min(lo + limit, len(self))
+        hi = lo
+        while hi < end and self._key(hi).startswith(prefix):
+            hi += 1
+        return range(lo, hi)
+
+    def lookup(self, text: str) -> Optional[Place]:
+        """Return the city whose name exactly matches ``text``.
+
+        ``None`` is returned when no city or several distinct cities share the name, so
+        the caller can offer :meth:`suggest` instead.
+        """
+        key = normalize_location(text).encode("utf-8")
+        index = bisect_left(self._keys, key)
+        found: Optional[Place] = None
+        while index < len(self) and self._key(index) == key:
+            place = self.record(index)
+            if found is not None and (place.lat, place.lon) != (found.lat, found.lon):
+                return None
+            found = found or place
+            index += 1
+        return found
+
+    def suggest(self, text: str, limit: int = SUGGESTION_LIMIT) -> List[Place]:
+        """Return up to ``limit`` distinct cities by prefix, then by fuzzy match."""
+        key = normalize_location(text)
+        if not key:
+            return []
+        indexes = list(self._range(key.encode("utf-8"), limit))
+        if len(indexes) < limit:
+            # Fuzzy candidates share the first two characters and are taken from a window
+            # of keys around where ``text`` would sort, which caps the difflib scan
+            head = key[:2].encode("utf-8")
+            position = bisect_left(self._keys, key.encode("utf-8"))
+            window = range(max(position - FUZZY_WINDOW, 0), min(position + FUZZY_WINDOW, len(self)))
+            candidates: Dict[str, List[int]] = {}
+            for i in window:
+                candidate = self._key(i)
+                if candidate.startswith(head):
+                    candidates.setdefault(candidate.decode("utf-8"), []).append(i)
+            for match in get_close_matches(key, candidates, n=limit, cutoff=0.75):
+                indexes.extend(candidates[match])
+
+        places: List[Place] = []
+        seen = set()
+        for index in indexes:
+            place = self.record(index)
+            if (place.lat, place.lon) not in seen:
+                seen.add((place.lat, place.lon))
+                places.append(place)
+        return places[:limit]
+
+
+def build_gazetteer(city_list_path: str, out_path: str) -> None:
+    """Build a gazetteer file from OpenWeatherMap's ``city.list.json`` export."""
+    with open(city_list_path, encoding="utf-8") as fh:
+        cities = json.load(fh)
+    rows = sorted(
+        (
+            normalize_location(city["name"]).encode("utf-8"),
+            city["name"],
+            city["coord"]["lat"],
+            city["coord"]["lon"],
+            city["id"],
+        )
+        for city in cities
+    )
+    with open(out_path, "w", encoding="utf-8") as fh:
+        for key, name, lat, lon, city_id in rows:
+            fh.write(f"{key.decode('utf-8')}\t{name}\t{lat}\t{lon}\t{city_id}\n")
+
+
+if __name__ == "__main__":
+    build_gazetteer(sys.argv[1], sys.argv[2])
@@ -1,24 +1,491 @@
+import hashlib
+import json
 import os
+import sqlite3
+import struct
+import time
+from collections import Counter, OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+import httpx
 import requests
-from typing import Optional
+
+FORECAST_URL = "https://api.openweathermap.org/data/2.5/forecast"
+GEOCODE_URL = "https://api.openweathermap.org/geo/1.0/direct"
+MAX_CONNECTIONS = int(os.getenv("WEATHER_MAX_CONNECTIONS", "20"))
+REQUEST_TIMEOUT = 10
+CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "1800"))
+CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "1024"))
+GEOCODE_TTL = float(os.getenv("WEATHER_GEOCODE_TTL", str(7 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = float(os.getenv("WEATHER_GEOCODE_NEGATIVE_TTL", "3600"))
+ADAPTIVE_INITIAL_INTERVAL = float(os.getenv("WEATHER_ADAPTIVE_INITIAL_INTERVAL", "3600"))
+# Polling faster than the forecast cache TTL would only ever hit the cache
+ADAPTIVE_MIN_INTERVAL = float(os.getenv("WEATHER_ADAPTIVE_MIN_INTERVAL", str(CACHE_TTL)))
+ADAPTIVE_MAX_INTERVAL = float(os.getenv("WEATHER_ADAPTIVE_MAX_INTERVAL", str(6 * 3600)))
+ADAPTIVE_BACKOFF = float(os.getenv("WEATHER_ADAPTIVE_BACKOFF", "1.5"))
+# The 5-day/3-hour forecast endpoint spans 120 hours from now, so only the
+# next four days after today are covered from midnight to midnight
+FORECAST_HORIZON_DAYS = 4
+TEMP_DELTA = float(os.getenv("WEATHER_TEMP_DELTA", "2.0"))
+POP_DELTA = float(os.getenv("WEATHER_POP_DELTA", "0.3"))
+
+# Packed snapshot slot: slot time, temp_min and temp_max in tenths of a degree, condition id,
+# pop in percent. A snapshot is the day's slots in time order, so changes can be compared
+# over the slots both forecasts still cover
+SNAPSHOT_FORMAT = struct.Struct("<IhhHB")
+# Local time of day from which a 3-hour slot reaches midnight
+LAST_SLOT_START = 21 * 3600
+
+CacheKey = Tuple[str, str, str]
+
+
+def normalize_location(location: str) -> str:
+    """Return a canonical key for user-entered location text."""
+    return " ".join(location.split()).casefold()
+
+
+@dataclass
+class DayForecast:
+    """Aggregated 3-hour slots of a single local calendar day.
+
+    ``complete`` is False when the forecast ends before the day does, which happens for
+    the last day of a response.
+    """
+
+    date: str
+    slots: list
+    temp_min: float
+    temp_max: float
+    description: str
+    weather_id: int
+    pop: float
+    complete: bool = True
+
+    def snapshot(self) -> bytes:
+        """Return the packed per-slot values change detection is based on."""
+        return b"".join(
+            SNAPSHOT_FORMAT.pack(
+                item["dt"],
+                round(item["main"]["temp_min"] * 10),
+                round(item["main"]["temp_max"] * 10),
+                item["weather"][0]["id"],
+                round(item.get("pop", 0.0) * 100),
+            )
+            for item in sorted(self.slots, key=lambda item: item["dt"])
+        )
+
+
+def snapshot_digest(snapshot: bytes) -> bytes:
+    """Return a fixed-width digest of ``snapshot`` for cheap equality checks in sqlite."""
+    return hashlib.blake2b(snapshot, digest_size=8).digest()
+
+
+def unpack_snapshot(snapshot: bytes) -> Dict[int, tuple]:
+    """Decode a snapshot into ``{slot dt: (temp_min, temp_max, weather_id, pop)}``.
+
+    Snapshots in an older format decode to an empty mapping.
+    """
+    if len(snapshot) % SNAPSHOT_FORMAT.size:
+        return {}
+    return {
+        dt: (temp_min / 10, temp_max / 10, weather_id, pop / 100)
+        for dt, temp_min, temp_max, weather_id, pop in SNAPSHOT_FORMAT.iter_unpack(snapshot)
+    }
+
+
+def daily_index(data: dict) -> Dict[str, DayForecast]:
+    """Group a forecast response into ``{YYYY-MM-DD: DayForecast}`` by the city's local date."""
+    offset = data.get("city", {}).get("timezone", 0)
+    slots_by_day: Dict[str, list] = defaultdict(list)
+    for item in data.get("list", []):
+        day = datetime.fromtimestamp(item["dt"] + offset, tz=timezone.utc).date().isoformat()
+        slots_by_day[day].append(item)
+
+    index = {}
+    for day, slots in slots_by_day.items():
+        descriptions = Counter(item["weather"][0]["description"] for item in slots)
+        weather_ids = Counter(item["weather"][0]["id"] for item in slots)
+        last_slot = (max(item["dt"] for item in slots) + offset) % 86400
+        index[day] = DayForecast(
+            date=day,
+            slots=slots,
+            temp_min=min(item["main"]["temp_min"] for item in slots),
+            temp_max=max(item["main"]["temp_max"] for item in slots),
+            description=descriptions.most_common(1)[0][0],
+            weather_id=weather_ids.most_common(1)[0][0],
+            pop=max(item.get("pop", 0.0) for item in slots),
+            complete=last_slot >= LAST_SLOT_START,
+        )
+    return index
+
+
+def condition_category(weather_id: int) -> int:
+    """Map an OpenWeatherMap condition id to a coarse category (thunderstorm, rain, clear, ...)."""
+    if weather_id == 800:
+        return 800
+    return weather_id // 100
+
+
+def _aggregate(slots: Iterable[tuple]) -> Tuple[float, float, int, float]:
+    """Aggregate decoded slots the way :func:`daily_index` aggregates a day."""
+    slots = list(slots)
+    weather_ids = Counter(slot[2] for slot in slots)
+    return (
+        min(slot[0] for slot in slots),
+        max(slot[1] for slot in slots),
+        weather_ids.most_common(1)[0][0],
+        max(slot[3] for slot in slots),
+    )
+
+
+class SignificancePolicy:
+    """Decide whether a forecast change is worth notifying subscribers about.
+
+    Only the slots present in both snapshots are compared, so today's elapsed slots
+    dropping out of the forecast do not count as a change.
+    """
+
+    def __init__(self, temp_delta: float = TEMP_DELTA, pop_delta: float = POP_DELTA):
+        self.temp_delta = temp_delta
+        self.pop_delta = pop_delta
+
+    @staticmethod
+    def comparable(old_snapshot: Optional[bytes], new_snapshot: bytes) -> bool:
+        """Whether the snapshots share any slot; if not, the new one is a fresh baseline."""
+        if old_snapshot is None:
+            return False
+        return not unpack_snapshot(old_snapshot).keys().isdisjoint(unpack_snapshot(new_snapshot))
+
+    def is_significant(self, old_snapshot: Optional[bytes], new_snapshot: bytes) -> bool:
+        if old_snapshot is None:
+            return True
+        if old_snapshot == new_snapshot:
+            return False
+        old = unpack_snapshot(old_snapshot)
+        new = unpack_snapshot(new_snapshot)
+        common = old.keys() & new.keys()
+        if not common:
+            return False
+        old_min, old_max, old_id, old_pop = _aggregate(old[dt] for dt in common)
+        new_min, new_max, new_id, new_pop = _aggregate(new[dt] for dt in common)
+        if condition_category(old_id) != condition_category(new_id):
+            return True
+        if abs(old_min - new_min) >= self.temp_delta:
+            return True
+        if abs(old_max - new_max) >= self.temp_delta:
+            return True
+        return abs(old_pop - new_pop) >= self.pop_delta
+
+
+class TTLCache:
+    """In-memory LRU cache whose entries expire after ``ttl`` seconds."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, data: Any, fetched_at: Optional[float] = None) -> None:
+        self._entries[key] = (time.time() if fetched_at is None else fetched_at, data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class ForecastCache(TTLCache):
+    """In-memory LRU cache of forecast responses keyed by (location, units, lang)."""
+
+    def __init__(self, ttl: float = CACHE_TTL, maxsize: int = CACHE_SIZE):
+        super().__init__(ttl, maxsize)
+
+    def flush(self) -> None:
+        """Persist buffered entries; the in-memory cache has nothing to do."""
+
+    def close(self) -> None:
+        self.flush()
+
+
+class PersistentForecastCache(ForecastCache):
+    """Forecast cache backed by a sqlite table so it survives restarts.
+
+    New entries are buffered and written in one transaction by :meth:`flush`, which the
+    bot calls once per update cycle.
+    """
+
+    def __init__(self, path: str, cold_start: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._unsaved: Dict[CacheKey, Tuple[float, dict]] = {}
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS forecast_cache("
+                "location TEXT, units TEXT, lang TEXT, fetched_at REAL, data TEXT, "
+                "PRIMARY KEY(location, units, lang)"
+                ")"
+            )
+            if cold_start:
+                self._conn.execute("DELETE FROM forecast_cache")
+            else:
+                self._conn.execute("DELETE FROM forecast_cache WHERE fetched_at < ?", (time.time() - self.ttl,))
+                rows = self._conn.execute(
+                    "SELECT location, units, lang, fetched_at, data FROM forecast_cache ORDER BY fetched_at"
+                ).fetchall()
+                for location, units, lang, fetched_at, data in rows:
+                    super().set((location, units, lang), json.loads(data), fetched_at)
+
+    def set(self, key: CacheKey, data: dict, fetched_at: Optional[float] = None) -> None:
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        super().set(key, data, fetched_at)
+        self._unsaved[key] = (fetched_at, data)
+
+    def flush(self) -> None:
+        if not self._unsaved:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO forecast_cache(location, units, lang, fetched_at, data) VALUES (?, ?, ?, ?, ?)",
+                (
+                    (*key, fetched_at, json.dumps(data, ensure_ascii=False))
+                    for key, (fetched_at, data) in self._unsaved.items()
+                ),
+            )
+        self._unsaved.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.close()
+
+
+@dataclass
+class ChangeHistory:
+    """What :class:`ChangeTracker` knows about one location."""
+
+    slots: Dict[int, tuple]
+    interval: float
+    polls: int = 1
+    changes: int = 0
+    last_change: float = field(default_factory=time.time)
+
+
+class ChangeTracker:
+    """Learns per location how often the provider's forecast data actually changes.
+
+    Each network response is compared with the previous one on the 3-hour slots both
+    cover, so slots rolling off the front are not counted as a change. An unchanged poll
+    stretches the location's refresh interval by ``backoff``; a change halves it.
+    """
+
+    def __init__(
+        self,
+        initial_interval: float = ADAPTIVE_INITIAL_INTERVAL,
+        min_interval: float = ADAPTIVE_MIN_INTERVAL,
+        max_interval: float = ADAPTIVE_MAX_INTERVAL,
+        backoff: float = ADAPTIVE_BACKOFF,
+    ):
+        self.initial_interval = initial_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._history: Dict[str, ChangeHistory] = {}
+
+    @staticmethod
+    def _slots(data: dict) -> Dict[int, tuple]:
+        return {
+            item["dt"]: (item["main"]["temp"], item["weather"][0]["id"], item.get("pop", 0.0))
+            for item in data.get("list", [])
+        }
+
+    def observe(self, key: str, data: dict) -> bool:
+        """Record a freshly fetched response; return whether the data changed."""
+        slots = self._slots(data)
+        history = self._history.get(key)
+        if history is None:
+            self._history[key] = ChangeHistory(slots, self.initial_interval)
+            return True
+        changed = any(slots[dt] != old for dt, old in history.slots.items() if dt in slots)
+        history.slots = slots
+        history.polls += 1
+        if changed:
+            history.changes += 1
+            history.last_change = time.time()
+            history.interval = max(self.min_interval, history.interval / 2)
+        else:
+            history.interval = min(self.max_interval, history.interval * self.backoff)
+        return changed
+
+    def interval(self, key: str) -> float:
+        history = self._history.get(key)
+        return self.initial_interval if history is None else history.interval
+
+    def intervals(self) -> Dict[str, dict]:
+        """Return the learned interval and change statistics of every tracked location."""
+        return {
+            key: {
+                "interval": history.interval,
+                "polls": history.polls,
+                "changes": history.changes,
+                "last_change": history.last_change,
+            }
+            for key, history in self._history.items()
+        }
+
+    def stats(self) -> dict:
+        intervals = sorted(history.interval for history in self._history.values())
+        if not intervals:
+            return {"locations": 0}
+        return {
+            "locations": len(intervals),
+            "min_interval": intervals[0],
+            "median_interval": intervals[len(intervals) // 2],
+            "max_interval": intervals[-1],
+        }
+
 
 class WeatherService:
     """Service to fetch weather data from OpenWeatherMap."""
 
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        max_connections: int = MAX_CONNECTIONS,
+        cache: Optional[ForecastCache] = None,
+        units: str = "metric",
+        lang: str = "ru",
+    ):
         self.api_key = api_key or os.getenv("WEATHER_API_KEY")
         if not self.api_key:
             raise ValueError("WEATHER_API_KEY is not set")
-    
-    def get_forecast(self, location: str) -> dict:
-        """Return weather forecast for the given location."""
-        url = "https://api.openweathermap.org/data/2.5/forecast"
-        params = {
-            "q": location,
+        self.max_connections = max_connections
+        self.cache = cache if cache is not None else ForecastCache()
+        self.changes = ChangeTracker()
+        self.units = units
+        self.lang = lang
+        # (name, lang) -> place, plus a shorter-lived record of names the provider does not know
+        self.geocode_cache = TTLCache(ttl=GEOCODE_TTL, maxsize=CACHE_SIZE)
+        self.unknown_places = TTLCache(ttl=GEOCODE_NEGATIVE_TTL, maxsize=CACHE_SIZE)
+        self._session = requests.Session()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _params(self, **query) -> dict:
+        return {
+            **query,
             "appid": self.api_key,
-            "units": "metric",
-            "lang": "ru",
+            "units": self.units,
+            "lang": self.lang,
         }
-        resp = requests.get(url, params=params, timeout=10)
+
+    def _cache_key(self, location: str) -> CacheKey:
+        return normalize_location(location), self.units, self.lang
+
+    def _coords_key(self, lat: float, lon: float) -> CacheKey:
+        return f"{lat:.4f},{lon:.4f}", self.units, self.lang
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Created lazily so the pool is bound to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=REQUEST_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    def get_forecast(self, location: str) -> dict:
+        """Return weather forecast for the given location."""
+        key = self._cache_key(location)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        resp = self._session.get(FORECAST_URL, params=self._params(q=location), timeout=REQUEST_TIMEOUT)
+        resp.raise_for_status()
+        data = resp.json()
+        self.cache.set(key, data)
+        self.changes.observe(key[0], data)
+        return data
+
+    async def aget_forecast(self, location: str) -> dict:
+        """Async variant of :meth:`get_forecast` using a pooled keep-alive client."""
+        return await self._afetch(self._cache_key(location), self._params(q=location))
+
+    async def aget_forecast_at(self, lat: float, lon: float) -> dict:
+        """Return weather forecast for resolved coordinates."""
+        return await self._afetch(self._coords_key(lat, lon), self._params(lat=lat, lon=lon))
+
+    async def _afetch(self, key: CacheKey, params: dict) -> dict:
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        resp = await self._get_client().get(FORECAST_URL, params=params)
         resp.raise_for_status()
-        return resp.json()
+        data = resp.json()
+        self.cache.set(key, data)
+        self.changes.observe(key[0], data)
+        return data
+
+    def refresh_interval(self, location: str, lat: Optional[float] = None, lon: Optional[float] = None) -> float:
+        """Return the learned polling interval in seconds for a location."""
+        key = self._cache_key(location) if lat is None or lon is None else self._coords_key(lat, lon)
+        return self.changes.interval(key[0])
+
+    async def aresolve(self, name: str) -> Optional[dict]:
+        """Resolve a city name to ``{"name", "lat", "lon"}``, or None if the provider does not know it."""
+        key = (normalize_location(name), self.lang)
+        place = self.geocode_cache.get(key)
+        if place is not None:
+            return place
+        if self.unknown_places.get(key) is not None:
+            return None
+        resp = await self._get_client().get(
+            GEOCODE_URL, params={"q": name, "limit": 1, "appid": self.api_key}
+        )
+        resp.raise_for_status()
+        results = resp.json()
+        if not results:
+            self.unknown_places.set(key, True)
+            return None
+        best = results[0]
+        place = {
+            "name": best.get("local_names", {}).get(self.lang, best["name"]),
+            "lat": best["lat"],
+            "lon": best["lon"],
+        }
+        self.geocode_cache.set(key, place)
+        return place
+
+    async def aclose(self) -> None:
+        """Close pooled HTTP connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self._session.close()
+        self.cache.close()